@@ -1,10 +1,21 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 import matplotlib.pyplot as plt
-from PIL import Image
+import scipy
+import scipy.stats
+import statsmodels
+import statsmodels.api as sm
 from streamlit_paste_button import paste_image_button
+import asyncio
+import hashlib
 import io
+import json
+import re
+import time
 
 # -----------------------------------------------------------------------------
 # 1. 基礎設定 (Page Config & Fonts)
@@ -26,12 +37,23 @@ if 'curr_df' not in st.session_state:
     st.session_state['curr_df'] = None
 if 'df_name' not in st.session_state:
     st.session_state['df_name'] = ""
+if 'df_hash' not in st.session_state:
+    st.session_state['df_hash'] = ""
+if 'var_types' not in st.session_state:
+    st.session_state['var_types'] = {}
 if 'research_q' not in st.session_state:
     st.session_state['research_q'] = ""
 if 'analysis_result' not in st.session_state:
     st.session_state['analysis_result'] = None
 if 'messages' not in st.session_state:
     st.session_state['messages'] = []
+# 對話附圖 (已編碼的 bytes 與 mime type，圖片改變時才重新編碼)
+if 'img_key' not in st.session_state:
+    st.session_state['img_key'] = None
+if 'img_bytes' not in st.session_state:
+    st.session_state['img_bytes'] = None
+if 'img_mime' not in st.session_state:
+    st.session_state['img_mime'] = None
 
 # -----------------------------------------------------------------------------
 # 3. API 連線設定
@@ -59,11 +81,254 @@ except Exception as e:
 
 
 # -----------------------------------------------------------------------------
-# 4. 介面主架構 (Title & Tabs)
+# 4. 共用函式 (Helpers)
+# -----------------------------------------------------------------------------
+# --- 模型呼叫與備援 ---
+# 同時競速的候補模型數量，與單次呼叫的逾時秒數
+RACE_TOP_N = 3
+MODEL_TIMEOUT = 30
+# 判斷是否為 429 / 配額類的可重試錯誤
+_RATE_LIMIT_RE = re.compile(r"429|quota|limit|\brate\b|exhaust", re.I)
+
+def is_rate_limit(e: Exception) -> bool:
+    return bool(_RATE_LIMIT_RE.search(str(e)))
+
+# Tab 4 程式碼生成用設定：調低 temperature 提高精準度，並限制輸出長度
+CODEGEN_CONFIG = genai.GenerationConfig(temperature=0.1, max_output_tokens=4096)
+
+@st.cache_resource
+def get_model(name: str, config: genai.GenerationConfig | None = None):
+    """
+    依 (模型名稱, 生成設定) 快取模型物件，避免每次重試都重新建立。
+    僅供同步呼叫 (stream_models) 使用；非同步競速由 race_models 另外建立模型與 async client。
+    """
+    return genai.GenerativeModel(name, generation_config=config)
+
+async def _generate_with_backoff(m_name, prompt, async_client, config=None):
+    """
+    呼叫單一模型，遇到 429 / Quota 類錯誤時以指數退避 (1s → 2s) 重試，每個模型最多嘗試 3 次。
+    其他錯誤直接拋出，交由 race_models 記錄。
+    """
+    temp_model = genai.GenerativeModel(m_name, generation_config=config)
+    # 使用這次競速專屬的 async client，而非 SDK 在整個 process 共用的預設 client
+    temp_model._async_client = async_client
+    for attempt in range(3):
+        try:
+            return await asyncio.wait_for(
+                temp_model.generate_content_async(prompt),
+                timeout=MODEL_TIMEOUT
+            )
+        except Exception as e:
+            if attempt < 2 and is_rate_limit(e):
+                await asyncio.sleep(2 ** attempt)
+                continue # retry same model
+            raise
+
+async def race_models(prompt, models, config=None):
+    """
+    以 RACE_TOP_N 個模型為一組同時發送請求，取第一個成功的回應並取消其餘請求；
+    整組皆失敗時才換下一組候補模型。
+    回傳 (response, errors)，全部失敗時 response 為 None。
+    """
+    errors = []
+    # SDK 預設的 async client 整個 process 共用，其 grpc.aio 連線綁定在建立時的 event loop；
+    # 每次 asyncio.run 都是新的 loop (多個 session 也可能同時競速)，因此每次競速都在
+    # 目前的 loop 上建立專屬 client，結束後關閉
+    async with genai_client._client_manager.make_client("generative_async") as async_client:
+        for i in range(0, len(models), RACE_TOP_N):
+            tasks = {
+                asyncio.create_task(_generate_with_backoff(m_name, prompt, async_client, config)): m_name
+                for m_name in models[i:i + RACE_TOP_N]
+            }
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    err = task.exception()
+                    if err is None:
+                        # 已有勝出模型，取消其餘請求以免浪費 token
+                        for p in pending:
+                            p.cancel()
+                        await asyncio.gather(*pending, return_exceptions=True)
+                        return task.result(), errors
+                    # 附上例外型別：asyncio.TimeoutError 等例外的訊息是空字串
+                    errors.append(f"{tasks[task]}: {type(err).__name__}: {err}")
+    return None, errors
+
+class ModelsExhaustedError(Exception):
+    """所有候補模型皆失敗，errors 為各模型的錯誤訊息。"""
+    def __init__(self, errors):
+        super().__init__("所有模型皆失敗")
+        self.errors = errors
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def gemini_analyze(prompt_hash: str, _prompt: str, models: tuple, config: genai.GenerationConfig | None = None) -> str:
+    """
+    以 prompt 的雜湊快取 AI 回覆，相同問題與資料再次送出時直接回傳結果，不消耗 API 配額。
+    全部模型失敗時拋出 ModelsExhaustedError (例外不會被快取，下次仍會重新呼叫)。
+    """
+    response, errors = asyncio.run(race_models(_prompt, models, config))
+    if response is None:
+        raise ModelsExhaustedError(errors)
+    return response.text
+
+def stream_models(prompt, models):
+    """
+    聊天用的串流版備援：依序嘗試候補模型，只在收到第一個 chunk 之前重試或換模型；
+    一旦開始串流就不再切換。回傳 (response, errors)，全部失敗時 response 為 None。
+    """
+    errors = []
+    for m_name in models:
+        last_error = None
+        for attempt in range(3):
+            try:
+                # stream=True 時 SDK 會先取回第一個 chunk，連線錯誤會在此拋出
+                return get_model(m_name).generate_content(prompt, stream=True), errors
+            except Exception as e:
+                last_error = e
+                if attempt < 2 and is_rate_limit(e):
+                    time.sleep(2 ** attempt)
+                    continue # retry same model
+                break # 換下一個模型
+        errors.append(f"{m_name}: {last_error}")
+    return None, errors
+
+# --- 資料讀取與剖析 ---
+# 只保留最近幾份解析結果：重新讀取已由 df_hash 把關，快取只需涵蓋短時間內的重複上傳，
+# 避免所有 session 上傳過的資料都常駐在整個 process 的記憶體中
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_df(file_hash: str, _file_bytes: bytes, ext: str) -> pd.DataFrame:
+    """
+    依檔案內容雜湊快取解析結果，重複上傳相同內容 (即使檔名不同) 不會再解析一次。
+    CSV 使用多執行緒的 PyArrow 引擎 (字串欄位以 Arrow 儲存，較省記憶體)，
+    PyArrow 無法解析、或有重複/空白欄名時退回預設引擎；Excel 使用 calamine 引擎，速度遠快於 openpyxl。
+    """
+    if ext == "csv":
+        try:
+            df = pd.read_csv(io.BytesIO(_file_bytes), engine="pyarrow", dtype_backend="pyarrow")
+        except (pa.ArrowInvalid, pd.errors.ParserError):
+            df = None
+        # PyArrow 不會重新命名重複或空白欄名，預設引擎會改成 score, score.1 與 Unnamed: 0
+        if df is None or df.columns.duplicated().any() or (df.columns == "").any():
+            df = pd.read_csv(io.BytesIO(_file_bytes))
+    else:
+        df = pd.read_excel(io.BytesIO(_file_bytes), engine="calamine")
+    return shrink_df(df)
+
+def shrink_df(df):
+    """
+    縮小資料在 session 中的記憶體用量：重複值多 (不重複比例 < 0.5) 的字串欄位轉為 category。
+    數值欄位維持原本的 int64 / float64，不做降級：
+    Tab 4 的 AI 程式碼直接在 df 上運算，int8 相加會溢位，float32 會改變檢定的 t 值與 p 值。
+    """
+    n_rows = max(len(df), 1)
+    for c in df.select_dtypes(include=["object", "string"]).columns:
+        n_unique = df[c].nunique()
+        # 全空欄位 (PyArrow 讀成 null 型態) 無法轉 category，維持原樣
+        if 0 < n_unique and n_unique / n_rows < 0.5:
+            df[c] = df[c].astype("category")
+    return df
+
+@st.cache_data(show_spinner=False)
+def profile_df(df_hash, _df):
+    """
+    建立變項資訊表，並回傳 {欄位名稱: 推測變項類型} 供其他分頁直接查詢。
+    以檔案雜湊 df_hash 作為快取鍵，同一份資料不會重複計算 nunique。
+    
+    簡易判斷規則：
+    1. 字串/Object/Category -> 名義變項
+    2. 數值型且不重複值少於 15 (通常是 Likert 量表或分組) -> 次序變項 (或名義)
+    3. 其餘數值型 -> 連續變項
+    """
+    dtypes = _df.dtypes
+    # 一次計算所有欄位的不重複值數量
+    nuniques = _df.nunique(dropna=True)
+    string_mask = dtypes.map(
+        lambda t: pd.api.types.is_string_dtype(t)
+        or pd.api.types.is_object_dtype(t)
+        or isinstance(t, pd.CategoricalDtype)
+    ).to_numpy(dtype=bool)
+    numeric_mask = dtypes.map(pd.api.types.is_numeric_dtype).to_numpy(dtype=bool)
+    var_types_arr = np.select(
+        [string_mask, numeric_mask & (nuniques.to_numpy() <= 15), numeric_mask],
+        ["名義變項", "次序變項", "連續變項"],  # 次序變項或是名義變項，這裡簡化歸類為次序/分組
+        default="未知"
+    )
+    # 簡單範例值 (取前 50 列中前 3 個不重複值)
+    head = _df.head(50)
+    # 轉成 list 再顯示，避免 Arrow 欄位印出 ArrowExtensionArray 的冗長表示
+    examples = [str(head[col].dropna().unique()[:3].tolist()) for col in _df.columns]
+    
+    df_info = pd.DataFrame({
+        "欄位名稱": _df.columns,
+        "推測變項類型": var_types_arr,
+        "資料型態": dtypes.astype(str).to_numpy(),
+        "不重複值數量": nuniques.to_numpy(),
+        "範例值": examples
+    })
+    var_types = dict(zip(_df.columns, var_types_arr.tolist()))
+    return df_info, var_types
+
+@st.cache_data(show_spinner=False)
+def build_prompt_context(df_hash: str, _df: pd.DataFrame, _var_types: dict) -> tuple[str, str]:
+    """
+    組出 Tab 2 給 AI 的資料背景 (columns_info, data_head)。
+    變項類型直接查上傳時算好的 _var_types (由 df_hash 決定，不另外列入快取鍵)。
+    資料預覽用 CSV 而非 Markdown 表格，AI 一樣讀得懂，也不需要 tabulate。
+    """
+    dtypes = _df.dtypes
+    columns_info = "\n".join(
+        f"- {col}: {_var_types.get(col, '未知')} ({dtypes[col]})"
+        for col in _df.columns
+    )
+    data_head = _df.head().to_csv(index=False)
+    return columns_info, data_head
+
+@st.cache_data(show_spinner=False)
+def build_code_context(df_hash: str, _df: pd.DataFrame, _var_types: dict) -> str:
+    """
+    組出 Tab 4 程式碼生成用的精簡資料背景：欄位型態 schema、推測變項類型與前 3 列範例 (JSON)。
+    AI 不必從原始列文字重新推測型態，寬表的 prompt token 數也少很多。
+    """
+    schema = {col: str(dt) for col, dt in _df.dtypes.items()}
+    sample = _df.head(3).to_dict(orient='records')
+    return json.dumps(
+        {"schema": schema, "var_types": _var_types, "sample": sample},
+        ensure_ascii=False,
+        default=str
+    )
+
+# --- AI 程式碼執行 ---
+# 擷取 AI 回覆中的第一個程式碼區塊 (```python ... ``` 或 ``` ... ```)
+# 結尾的 ``` 可省略：回覆被 max_output_tokens 截斷時仍能取出程式碼
+_CODE_RE = re.compile(r"```(?:python)?\s*\n(.*?)(?:```|\Z)", re.S)
+
+# 執行 AI 程式碼時固定提供的模組，只建立一次；每次執行再複製並加入 df
+_STATIC_NS = {
+    'st': st,
+    'pd': pd,
+    'plt': plt,
+    'np': np,
+    'scipy': scipy,
+    'statsmodels': statsmodels,
+    'sm': sm
+}
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def compile_code(code: str):
+    """快取編譯後的 code object，重複執行相同程式碼時不必重新解析。"""
+    return compile(code, '<ai>', 'exec')
+
+
+# -----------------------------------------------------------------------------
+# 5. 介面主架構 (Title & Tabs)
 # -----------------------------------------------------------------------------
 st.title("📊 JAMOVI 量化研究智能助手 V2")
 st.markdown("---")
 
+# Tab 3 直接顯示的最近訊息數量
+CHAT_WINDOW = 20
+
 tab1, tab2, tab3, tab4 = st.tabs(["📂 1. 數據上傳", "📝 2. 統計分析與 APA 報告", "💬 3. 自由咨詢室", "⚡ 4. Python 自動運算"])
 
 # =============================================================================
@@ -75,15 +340,19 @@ with tab1:
     
     if uploaded_file is not None:
         try:
-            # 讀取檔案
-            if uploaded_file.name != st.session_state['df_name']:
-                if uploaded_file.name.endswith('.csv'):
-                    df = pd.read_csv(uploaded_file)
-                else:
-                    df = pd.read_excel(uploaded_file)
+            # 讀取檔案 (以內容雜湊判斷是否為新資料，同名但內容不同也會重新讀取)
+            file_bytes = uploaded_file.getvalue()
+            file_hash = hashlib.md5(file_bytes).hexdigest()
+            if file_hash != st.session_state['df_hash']:
+                ext = uploaded_file.name.rsplit('.', 1)[-1].lower()
+                df = load_df(file_hash, file_bytes, ext)
                 
                 st.session_state['curr_df'] = df
                 st.session_state['df_name'] = uploaded_file.name
+                st.session_state['df_hash'] = file_hash
+                _, st.session_state['var_types'] = profile_df(st.session_state['df_hash'], df)
+                # 預先組好 Tab 3 用的欄位資訊，避免每次重新整理都重建
+                st.session_state['df_context_str'] = "欄位資訊：" + repr(df.dtypes.astype(str).to_dict())
                 # 清空舊的對話與分析結果，因為資料換了
                 st.session_state['analysis_result'] = None
                 st.session_state['messages'] = []
@@ -93,43 +362,8 @@ with tab1:
             
             st.success(f"目前檔案：{st.session_state['df_name']}")
             
-            # --- 自動判讀變項類型 ---
-            def detect_variable_type(series):
-                """
-                簡易判斷規則：
-                1. 字串/Object -> 名義變項
-                2. 數值型且不重複值少於 15 (通常是 Likert 量表或分組) -> 次序變項 (或名義)
-                3. 其餘數值型 -> 連續變項
-                """
-                if pd.api.types.is_string_dtype(series) or pd.api.types.is_object_dtype(series):
-                    return "名義變項"
-                elif pd.api.types.is_numeric_dtype(series):
-                    # 判斷是否為「類別/次序」性質的數值
-                    n_unique = series.nunique()
-                    if n_unique <= 15: 
-                        return "次序變項"  # 或是名義變項，這裡簡化歸類為次序/分組
-                    else:
-                        return "連續變項"
-                return "未知"
-
-            # 建立變項資訊表
-            var_info = []
-            for col in df.columns:
-                dtype = str(df[col].dtype)
-                n_unique = df[col].nunique()
-                var_type = detect_variable_type(df[col])
-                # 簡單範例值 (取前 3 個不重複值)
-                examples = str(df[col].dropna().unique()[:3])
-                
-                var_info.append({
-                    "欄位名稱": col,
-                    "推測變項類型": var_type,
-                    "資料型態": dtype,
-                    "不重複值數量": n_unique,
-                    "範例值": examples
-                })
-            
-            df_info = pd.DataFrame(var_info)
+            # --- 自動判讀變項類型 (依檔案雜湊快取) ---
+            df_info, _ = profile_df(st.session_state['df_hash'], df)
 
             col_a, col_b = st.columns([1, 1])
             with col_a:
@@ -138,9 +372,9 @@ with tab1:
             with col_b:
                 st.subheader("2. 變項類型自動偵測")
                 st.dataframe(
-                    df_info.style.map(
-                        lambda x: 'background-color: #d4edda' if x == '連續變項' else 
-                                  ('background-color: #fff3cd' if x == '次序變項' else ''),
+                    df_info.style.apply(
+                        lambda s: np.where(s == '連續變項', 'background-color: #d4edda',
+                                           np.where(s == '次序變項', 'background-color: #fff3cd', '')),
                         subset=['推測變項類型']
                     ),
                     use_container_width=True,
@@ -177,20 +411,11 @@ with tab2:
             with st.spinner("🤖 AI 正在思考統計策略、撰寫 JAMOVI 教學並生成 APA 報告..."):
                 try:
                     df = st.session_state['curr_df']
-                    # 準備 PromptContext
+                    # 準備 PromptContext (依檔案雜湊快取，同一份資料不重複組字串)
                     # 將自動判讀的變項類型也提供給 AI
-                    var_desc_list = []
-                    for col in df.columns:
-                        v_type = "名義變項"
-                        if pd.api.types.is_numeric_dtype(df[col]):
-                            if df[col].nunique() <= 15:
-                                v_type = "次序變項"
-                            else:
-                                v_type = "連續變項"
-                        var_desc_list.append(f"- {col}: {v_type} ({str(df[col].dtype)})")
-                    
-                    columns_info = "\n".join(var_desc_list)
-                    data_head = df.head().to_markdown(index=False)
+                    columns_info, data_head = build_prompt_context(
+                        st.session_state['df_hash'], df, st.session_state['var_types']
+                    )
                     
                     system_prompt = f"""
                     你是一位精通統計學與 JAMOVI 軟體操作的學術顧問，同時也是 APA 第七版格式的寫作專家。
@@ -220,45 +445,18 @@ with tab2:
                     - **APA 表格**：請用 Markdown Table 製作一個符合 APA 三線表格式（只有頂線、底線、標題下線）的表格範例。標題需如：**Table 1** *Means and Standard Deviations...*
                     """
                     
-                    # 嘗試呼叫 API，若失敗則嘗試其他模型
-                    response = None
-                    tab2_errors = []
-                    
-                    import time
-                    for m_name in candidate_models:
-                        # Retry logic for each model
-                        success = False
-                        last_error = None
-                        for attempt in range(3):
-                            try:
-                                temp_model = genai.GenerativeModel(m_name)
-                                response = temp_model.generate_content(system_prompt)
-                                success = True
-                                break # break retry loop
-                            except Exception as e:
-                                last_error = e
-                                err_msg = str(e)
-                                if "429" in err_msg or "Quota" in err_msg or "limit" in err_msg:
-                                    time.sleep(5)
-                                    continue # retry same model
-                                else:
-                                    # Non-recoverable error
-                                    break 
-                        
-                        if success:
-                            break # break model loop
-                        else:
-                            # Model failed after retries
-                            if last_error:
-                                tab2_errors.append(f"{m_name}: {last_error}")
-                    
-                    if response:
-                        st.session_state['analysis_result'] = response.text
-                    else:
+                    # 嘗試呼叫 API，多個候補模型同時競速，取最先成功者 (相同 prompt 直接取快取)
+                    try:
+                        st.session_state['analysis_result'] = gemini_analyze(
+                            hashlib.sha1(system_prompt.encode()).hexdigest(),
+                            system_prompt,
+                            tuple(candidate_models)
+                        )
+                    except ModelsExhaustedError as e:
                         st.error("分析過程發生錯誤 (所有模型皆失敗)。詳細原因：")
-                        for err in tab2_errors:
+                        for err in e.errors:
                             st.error(err)
-                        if not tab2_errors:
+                        if not e.errors:
                             st.error(f"Debug: 錯誤列表為空。模型清單長度: {len(candidate_models)}")
 
                 except Exception as e:
@@ -279,10 +477,12 @@ with tab3:
         st.info("💡 上傳資料後，AI 將能根據您的變數進行更精準的回答。目前僅提供通用諮詢。")
         context_str = "使用者尚未上傳資料，請回答一般統計問題。"
     else:
-        df = st.session_state['curr_df']
+        if 'df_context_str' not in st.session_state:
+            df = st.session_state['curr_df']
+            st.session_state['df_context_str'] = "欄位資訊：" + repr(df.dtypes.astype(str).to_dict())
         context_str = f"""
         【目前資料背景】
-        - 欄位資訊：{str(df.dtypes.to_dict())}
+        - {st.session_state['df_context_str']}
         - 使用者目前的研究問題：{st.session_state.get('research_q', '尚未設定')}
         """
 
@@ -302,21 +502,48 @@ with tab3:
                 key="paste_btn"
             )
         
-        image_content = None
-        
         # 優先處理貼上的圖片
         if paste_result.image_data is not None:
-            image_content = paste_result.image_data
+            pasted = paste_result.image_data
+            img_key = hashlib.md5(pasted.tobytes()).hexdigest()
+            if img_key != st.session_state['img_key']:
+                # 只在圖片改變時編碼一次 PNG，之後直接重用 bytes
+                buf = io.BytesIO()
+                pasted.save(buf, format="PNG")
+                st.session_state['img_key'] = img_key
+                st.session_state['img_bytes'] = buf.getvalue()
+                st.session_state['img_mime'] = "image/png"
             st.success("已成功貼上截圖！")
-            st.image(image_content, caption="剪貼簿圖片", width=300)
+            st.image(st.session_state['img_bytes'], caption="剪貼簿圖片", width=300)
         # 其次處理上傳的圖片 (若使用者同時操作，這裡邏輯是後者蓋前者，或可並存，此處先擇一)
         elif uploaded_img:
-            image_content = Image.open(uploaded_img)
-            st.image(image_content, caption="已上傳檔案", width=300)
+            # 上傳的檔案本身就是已編碼的圖片，直接沿用原始 bytes
+            img_bytes = uploaded_img.getvalue()
+            img_key = hashlib.md5(img_bytes).hexdigest()
+            if img_key != st.session_state['img_key']:
+                st.session_state['img_key'] = img_key
+                st.session_state['img_bytes'] = img_bytes
+                st.session_state['img_mime'] = uploaded_img.type
+            st.image(st.session_state['img_bytes'], caption="已上傳檔案", width=300)
+        else:
+            st.session_state['img_key'] = None
+            st.session_state['img_bytes'] = None
+            st.session_state['img_mime'] = None
+        
+        image_content = None
+        if st.session_state['img_bytes']:
+            image_content = {'mime_type': st.session_state['img_mime'], 'data': st.session_state['img_bytes']}
 
-    # 顯示歷史訊息
-    for msg in st.session_state['messages']:
-        st.chat_message(msg["role"]).write(msg["content"])
+    # 顯示歷史訊息 (只直接顯示最近 CHAT_WINDOW 則，較早的需手動展開)
+    recent = st.session_state['messages'][-CHAT_WINDOW:]
+    older = st.session_state['messages'][:-CHAT_WINDOW]
+    with st.container():
+        # 摺疊區 (expander) 收合時內容仍會被渲染，改用開關，開啟時才繪製較早的訊息
+        if older and st.toggle(f"顯示較早的 {len(older)} 則訊息", key="show_older_msgs"):
+            for msg in older:
+                st.chat_message(msg["role"]).write(msg["content"])
+        for msg in recent:
+            st.chat_message(msg["role"]).write(msg["content"])
 
     # 處理使用者輸入
     if prompt := st.chat_input("請輸入您的問題... (例如：這筆資料適合做因素分析嗎？)"):
@@ -325,7 +552,7 @@ with tab3:
         st.chat_message("user").write(prompt)
         if image_content:
              # 若有圖片，也存入紀錄以便顯示
-             st.chat_message("user").image(image_content, caption="User Uploaded Image", width=300)
+             st.chat_message("user").image(st.session_state['img_bytes'], caption="User Uploaded Image", width=300)
         
         # 2. 呼叫 AI (含 retry 機制)
         try:
@@ -342,41 +569,14 @@ with tab3:
             if image_content:
                 input_content = [full_prompt, image_content]
 
-            ai_reply = None
-            chat_error_details = []
-            
-            for m_name in candidate_models:
-                # Retry logic for chat
-                success = False
-                last_error = None
-                for attempt in range(3):
-                    try:
-                        chat_model = genai.GenerativeModel(m_name)
-                        # 聊天用 stream=True 體驗較好，但這裡用一次性生成比較簡單
-                        response = chat_model.generate_content(input_content)
-                        ai_reply = response.text
-                        success = True
-                        break # break retry loop
-                    except Exception as e:
-                        last_error = e
-                        err_msg = str(e)
-                        if "429" in err_msg or "Quota" in err_msg or "limit" in err_msg:
-                            import time
-                            time.sleep(5)
-                            continue # retry same model
-                        else:
-                            break # break retry loop
-                
-                if success:
-                    break # break model loop
-                else:
-                    if last_error:
-                         chat_error_details.append(f"{m_name}: {last_error}")
+            response, chat_error_details = stream_models(input_content, candidate_models)
             
-            if ai_reply:
-                # 3. 顯示與儲存 AI 回覆
+            if response:
+                # 3. 串流顯示並儲存 AI 回覆
+                ai_reply = st.chat_message("assistant").write_stream(
+                    chunk.text for chunk in response
+                )
                 st.session_state['messages'].append({"role": "assistant", "content": ai_reply})
-                st.chat_message("assistant").write(ai_reply)
             else:
                 st.error("所有模型嘗試皆失敗。詳細錯誤：")
                 st.json(chat_error_details)
@@ -406,6 +606,9 @@ with tab4:
             with st.spinner("🤖 正在生成並執行 Python 統計腳本..."):
                 try:
                      # 1. 生成程式碼
+                    code_context = build_code_context(
+                        st.session_state['df_hash'], df, st.session_state['var_types']
+                    )
                     code_prompt = f"""
                     You are a Python Data Analyst Expert.
                     
@@ -413,9 +616,8 @@ with tab4:
                     Write a Python script to perform statistical analysis based on the user's dataframe and question.
                     
                     【Data Context】
-                    - Columns: {list(df.columns)}
-                    - Data Sample (first 5 rows):
-                    {df.head().to_string()}
+                    - Column schema (dtypes), inferred measurement levels (var_types) and first 3 rows, as JSON:
+                    {code_context}
                     
                     【User Question】
                     {st.session_state['research_q']}
@@ -435,42 +637,25 @@ with tab4:
                     
                     generated_code = ""
                     tab4_errors = []
-                    
-                    import time
-                    for m_name in candidate_models:
-                        # Retry logic for code generation
-                        success = False
-                        last_error = None
-                        for attempt in range(3):
-                            try:
-                                # 為了程式碼生成精準度，將 temperature 調低
-                                gen_config = genai.GenerationConfig(temperature=0.1)
-                                code_model = genai.GenerativeModel(m_name, generation_config=gen_config)
-                                resp = code_model.generate_content(code_prompt)
-                                generated_code = resp.text
-                                success = True
-                                break # break retry loop
-                            except Exception as e:
-                                last_error = e
-                                err_msg = str(e)
-                                if "429" in err_msg or "Quota" in err_msg or "limit" in err_msg:
-                                    time.sleep(5)
-                                    continue # retry same model
-                                else:
-                                    break # break retry loop
-                        
-                        if success:
-                            break # break model loop
-                        else:
-                            if last_error:
-                                tab4_errors.append(f"{m_name}: {last_error}")
+                    # 為了程式碼生成精準度，將 temperature 調低 (結果穩定，適合快取)
+                    codegen_args = (
+                        hashlib.sha1(code_prompt.encode()).hexdigest(),
+                        code_prompt,
+                        tuple(candidate_models),
+                        CODEGEN_CONFIG
+                    )
+                    try:
+                        generated_code = gemini_analyze(*codegen_args)
+                    except ModelsExhaustedError as e:
+                        tab4_errors = e.errors
                     
                     if not generated_code:
                         st.error("無法生成程式碼，可能是所有模型連線失敗。詳細錯誤如下：")
                         st.json(tab4_errors)
                     else:
                         # 2. 清理程式碼
-                        cleaned_code = generated_code.replace("```python", "").replace("```", "").strip()
+                        m = _CODE_RE.search(generated_code)
+                        cleaned_code = (m.group(1) if m else generated_code).strip()
                         
                         st.subheader("📝 生成的分析程式碼：")
                         with st.expander("點擊查看原始碼"):
@@ -478,16 +663,14 @@ with tab4:
                             
                         # 3. 執行程式碼
                         st.subheader("📊 運算結果：")
-                        local_vars = {
-                            'df': df,
-                            'st': st,
-                            'pd': pd,
-                            'plt': plt,
-                            'scipy': __import__('scipy'),
-                            'statsmodels': __import__('statsmodels')
-                        }
+                        namespace = {**_STATIC_NS, 'df': df}
                         
-                        exec(cleaned_code, globals(), local_vars)
+                        try:
+                            exec(compile_code(cleaned_code), namespace)
+                        except Exception:
+                            # 執行失敗的程式碼不保留在快取，再按一次會重新生成
+                            gemini_analyze.clear(*codegen_args)
+                            raise
                         
                 except Exception as e:
                     st.error(f"程式執行發生錯誤：{e}")
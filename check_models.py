@@ -1,15 +1,14 @@
 import google.generativeai as genai
 import os
 import sys
+import tomllib
+from pathlib import Path
 
 # Load API Key from secrets
 key = None
 try:
-    with open(".streamlit/secrets.toml", "r", encoding="utf-8") as f:
-        for line in f:
-            if "GOOGLE_API_KEY" in line:
-                key = line.split("=")[1].strip().strip('"').strip("'")
-                break
+    with open(".streamlit/secrets.toml", "rb") as f:
+        key = tomllib.load(f).get("GOOGLE_API_KEY")
 except Exception as e:
     print(f"Error loading secrets: {e}")
     exit(1)
@@ -21,13 +20,15 @@ if not key:
 genai.configure(api_key=key)
 
 
-with open("available_models.txt", "w", encoding="utf-8") as f:
-    f.write("Listing available models:\n")
-    try:
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                f.write(f"- {m.name}\n")
-    except Exception as e:
-        f.write(f"Error listing models: {e}\n")
+# Collect output in memory and write the file once
+lines = ["Listing available models:\n"]
+try:
+    for m in genai.list_models():
+        if 'generateContent' in m.supported_generation_methods:
+            lines.append(f"- {m.name}\n")
+except Exception as e:
+    lines.append(f"Error listing models: {e}\n")
+
+Path("available_models.txt").write_text("".join(lines), encoding="utf-8")
 
 print("Done writing to available_models.txt")
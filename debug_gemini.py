@@ -1,6 +1,7 @@
 import google.generativeai as genai
 import os
 import sys
+import tomllib
 
 # Redirect stdout/stderr to a file
 log_file = open("gemini_log_v2.txt", "w", encoding="utf-8")
@@ -9,11 +10,8 @@ sys.stderr = log_file
 
 key = None
 try:
-    with open(".streamlit/secrets.toml", "r", encoding="utf-8") as f:
-        for line in f:
-            if "GOOGLE_API_KEY" in line:
-                key = line.split("=")[1].strip().strip('"').strip("'")
-                break
+    with open(".streamlit/secrets.toml", "rb") as f:
+        key = tomllib.load(f).get("GOOGLE_API_KEY")
 except Exception as e:
     print(f"Error loading secrets: {e}")
     exit(1)